@@ -5,7 +5,7 @@ Stochasticitity for ACM CHIL 2020 paper
 Neal G. Ravindra, 200228
 '''
 
-import os,sys,pickle,time,random,glob
+import os,sys,pickle,hashlib,time,random
 import numpy as np
 import pandas as pd
 
@@ -14,33 +14,40 @@ import copy
 import os.path as osp
 import torch
 import torch.utils.data
-from torch_sparse import SparseTensor, cat
+from torch_sparse import SparseTensor
 from torch_geometric.data import Data
 import torch.nn.functional as F
 from torch_geometric.nn import GCNConv, GATConv
 
 
 ## utils
-def scipysparse2torchsparse(x) :
+def scipysparse2edge_index(x) :
     '''
     Input: scipy csr_matrix
-    Returns: torch tensor in experimental sparse format
+    Returns: edge_index (2 x nnz LongTensor), the COO row/col copied once into int64
 
     REF: Code adatped from [PyTorch discussion forum](https://discuss.pytorch.org/t/better-way-to-forward-sparse-matrix/21915>)
     '''
-    samples=x.shape[0]
-    features=x.shape[1]
-    values=x.data
     coo_data=x.tocoo()
-    indices=torch.LongTensor([coo_data.row,coo_data.col]) # OR transpose list of index tuples
-    t=torch.sparse.FloatTensor(indices,torch.from_numpy(values).float(),[samples,features])
-    return indices,t
+    edge_index=np.empty((2,coo_data.nnz),dtype=np.int64)
+    edge_index[0],edge_index[1]=coo_data.row,coo_data.col
+    return torch.from_numpy(edge_index)
 
 def accuracy(output, labels):
-    preds = output.max(1)[1].type_as(labels)
-    correct = preds.eq(labels).double()
-    correct = correct.sum()
-    return correct / len(labels)
+    preds = output.argmax(1)
+    return preds.eq(labels).float().mean()
+
+def add_adj_t(data):
+    '''Cache the transposed adjacency so GATConv skips the per-call CSR build'''
+    row, col = data.edge_index
+    data.adj_t = SparseTensor(row=row, col=col, value=None,
+                              sparse_sizes=(data.num_nodes, data.num_nodes)).t()
+    data.edge_index = None # GAT reads adj_t only; don't copy edge_index to device
+    return data
+
+def snapshot_state(model):
+    '''Detached CPU copy of the model weights'''
+    return {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
 
 ## load data
 class ClusterData(torch.utils.data.Dataset):
@@ -55,8 +62,10 @@ class ClusterData(torch.utils.data.Dataset):
         recursive (bool, optional): If set to :obj:`True`, will use multilevel
             recursive bisection instead of multilevel k-way partitioning.
             (default: :obj:`False`)
-        save_dir (string, optional): If set, will save the partitioned data to
-            the :obj:`save_dir` directory for faster re-use.
+        save_dir (string, optional): If set, will save the partition
+            (adjacency, :obj:`partptr`, :obj:`perm`) to the :obj:`save_dir`
+            directory for faster re-use. The file name includes a hash of
+            :obj:`edge_index`, so a changed graph is re-partitioned.
     """
     def __init__(self, data, num_parts, recursive=False, save_dir=None):
         assert (data.edge_index is not None)
@@ -69,29 +78,36 @@ class ClusterData(torch.utils.data.Dataset):
 
     def process(self, data):
         recursive = '_recursive' if self.recursive else ''
-        filename = f'part_data_{self.num_parts}{recursive}.pt'
+        # key the cache on the graph itself so a pickle regenerated under the same
+        # name (new kNN graph or cells) never picks up a partition of the old one
+        num_nodes, num_edges = data.num_nodes, data.edge_index.size(1)
+        digest = hashlib.sha1(data.edge_index.numpy()).hexdigest()[:12]
+        filename = f'part_data_{self.num_parts}{recursive}_{digest}.pt'
 
+        # only the partition is cached; node tensors are re-permuted every run
         path = osp.join(self.save_dir or '', filename)
+        adj = None
         if self.save_dir is not None and osp.exists(path):
-            data, partptr, perm = torch.load(path)
-        else:
-            data = copy.copy(data)
-            num_nodes = data.num_nodes
-
+            adj, partptr, perm = torch.load(path, weights_only=False)
+            if perm.numel() != num_nodes or adj.nnz() != num_edges:
+                adj = None
+        if adj is None:
             (row, col), edge_attr = data.edge_index, data.edge_attr
             adj = SparseTensor(row=row, col=col, value=edge_attr)
             adj, partptr, perm = adj.partition(self.num_parts, self.recursive)
 
-            for key, item in data:
-                if item.size(0) == num_nodes:
-                    data[key] = item[perm]
+            if self.save_dir is not None:
+                torch.save((adj, partptr, perm), path)
+
+        data = copy.copy(data)
+        data.edge_index = None
+        data.edge_attr = None
 
-            data.edge_index = None
-            data.edge_attr = None
-            data.adj = adj
+        for key, item in data:
+            if item.size(0) == num_nodes:
+                data[key] = item[perm]
 
-            if self.save_dir is not None:
-                torch.save((data, partptr, perm), path)
+        data.adj = adj
 
         self.data = data
         self.perm = perm
@@ -155,43 +171,56 @@ class ClusterLoader(torch.utils.data.DataLoader):
 
                 data = copy.copy(cluster_data.data)
                 num_nodes = data.num_nodes
+                data.adj = None # collate gathers rows from cluster_data.data.adj directly
                 for key, item in data:
                     if item.size(0) == num_nodes:
                         data[key] = item.narrow(0, start, length)
 
                 return data, idx
 
+        # batch-local relabelling of node ids, reset after every batch
+        node_map = torch.full((cluster_data.data.adj.size(1),), -1, dtype=torch.long)
+
         def collate(batch):
             data_list = [data[0] for data in batch]
             parts: List[int] = [data[1] for data in batch]
             partptr = cluster_data.partptr
 
-            adj = cat([data.adj for data in data_list], dim=0)
-
-            adj = adj.t()
-            adjs = []
-            for part in parts:
-                start = partptr[part]
-                length = partptr[part + 1] - start
-                adjs.append(adj.narrow(0, start, length))
-            adj = cat(adjs, dim=0).t()
-            row, col, value = adj.coo()
+            # node ids of the sampled parts in batch order, gathered in one row select
+            parts_t = torch.tensor(parts, dtype=torch.long)
+            start = partptr[parts_t]
+            length = partptr[parts_t + 1] - start
+            num_nodes = int(length.sum())
+            node_idx = (torch.repeat_interleave(start - (length.cumsum(0) - length), length)
+                        + torch.arange(num_nodes))
+            row, col, value = cluster_data.data.adj.index_select(0, node_idx).coo()
+
+            # keep only the links between the sampled parts, relabelled to batch ids
+            node_map[node_idx] = torch.arange(num_nodes)
+            col = node_map[col]
+            node_map[node_idx] = -1
+            keep = col >= 0
+            value = value[keep] if value is not None else None
+            adj = SparseTensor(row=row[keep], col=col[keep], value=value,
+                               sparse_sizes=(num_nodes, num_nodes))
 
             data = cluster_data.data.__class__()
             data.num_nodes = adj.size(0)
-            data.edge_index = torch.stack([row, col], dim=0)
-            data.edge_attr = value
+            data.adj_t = adj.t()
 
             ref = data_list[0]
-            keys = ref.keys
-            keys.remove('adj')
-
-            for key in keys:
-                if ref[key].size(0) != ref.adj.size(0):
+            for key in ref.keys:
+                if ref[key].size(0) != ref.num_nodes:
                     data[key] = ref[key]
                 else:
-                    data[key] = torch.cat([d[key] for d in data_list],
-                                          dim=ref.__cat_dim__(key, ref[key]))
+                    cat_dim = ref.__cat_dim__(key, ref[key])
+                    items = [d[key] for d in data_list]
+                    if items[0].device.type == 'cpu' and items[0].dtype != torch.bfloat16:
+                        # one numpy concat avoids torch.cat dispatch overhead on many small parts
+                        data[key] = torch.from_numpy(
+                            np.concatenate([item.numpy() for item in items], axis=cat_dim))
+                    else:
+                        data[key] = torch.cat(items, dim=cat_dim)
 
             return data
 
@@ -214,7 +243,9 @@ replicate=sys.argv[1] # for pkl file saved
 
 BatchSize = 256
 NumParts = 4000 # num sub-graphs
+save_dir = os.path.join(pdfp,os.path.splitext(data_train_pkl)[0]) # METIS partition cache
 Device = 'cuda' # if no gpu, `Device='cpu'`
+NumWorkers = 4 # DataLoader workers for sub-graph collate
 LR = 0.001 # learning rate
 WeightDecay=5e-4
 fastmode = False # if `fastmode=False`, report validation
@@ -234,16 +265,19 @@ with open(os.path.join(pdfp,data_train_pkl),'rb') as f :
     f.close()
 
 node_features = torch.from_numpy(datapkl['features'].todense()).float()
-# _,node_features = scipysparse2torchsparse(features)
 labels = torch.LongTensor(datapkl['labels'])
-edge_index,_ = scipysparse2torchsparse(datapkl['adj'])
+num_classes = int(labels.max()) + 1
+edge_index = scipysparse2edge_index(datapkl['adj'])
 del datapkl
 
 d = Data(x=node_features, edge_index=edge_index, y=labels)
 del node_features,edge_index,labels
 
-cd = ClusterData(d,num_parts=NumParts)
-cl = ClusterLoader(cd,batch_size=BatchSize,shuffle=True)
+os.makedirs(save_dir,exist_ok=True)
+cd = ClusterData(d,num_parts=NumParts,save_dir=save_dir)
+cl = ClusterLoader(cd,batch_size=BatchSize,shuffle=True,
+                   num_workers=NumWorkers,pin_memory=(Device != 'cpu'),
+                   persistent_workers=(NumWorkers > 0))
 
 if not fastmode :
     with open(os.path.join(pdfp,data_val_pkl),'rb') as f :
@@ -252,25 +286,25 @@ if not fastmode :
 
     features_val = torch.from_numpy(datapkl['features'].todense()).float()
     labels_val = torch.LongTensor(datapkl['labels'])
-    edge_index_val,_ = scipysparse2torchsparse(datapkl['adj'])
+    edge_index_val = scipysparse2edge_index(datapkl['adj'])
     del datapkl
 
 ## model
 class GAT(torch.nn.Module):
-    def __init__(self):
+    def __init__(self, num_classes):
         super(GAT, self).__init__()
         self.gat1 = GATConv(d.num_node_features, out_channels=nHiddenUnits,
                             heads=nHeads, concat=True, negative_slope=alpha,
                             dropout=dropout, bias=True)
-        self.gat2 = GATConv(nHiddenUnits*nHeads, d.y.unique().size()[0],
+        self.gat2 = GATConv(nHiddenUnits*nHeads, num_classes,
                             heads=nHeads, concat=False, negative_slope=alpha,
                             dropout=dropout, bias=True)
 
     def forward(self, data):
-        x, edge_index = data.x, data.edge_index
-        x = self.gat1(x, edge_index)
+        x, adj_t = data.x, data.adj_t
+        x = self.gat1(x, adj_t)
         x = F.elu(x)
-        x = self.gat2(x, edge_index)
+        x = self.gat2(x, adj_t)
         return F.log_softmax(x, dim=1)
 
 
@@ -280,29 +314,31 @@ if False :
 else :
     device = torch.device(Device)
 
-random.seed(rs)
+torch.manual_seed(rs) # seeds all CUDA devices too
 np.random.seed(rs)
-torch.manual_seed(rs)
-if Device == 'cuda' :
-    torch.cuda.manual_seed(rs)
+random.seed(rs)
 
-model = GAT().to(device)
+model = GAT(num_classes).to(device)
 optimizer = torch.optim.Adagrad(model.parameters(),
                                 lr=LR,
                                 weight_decay=WeightDecay)
 
 # features, adj, labels = Variable(features), Variable(adj), Variable(labels)
 
+if not fastmode :
+    d_val = add_adj_t(Data(x=features_val,edge_index=edge_index_val,y=labels_val)).to(device)
+
 def train(epoch):
     t = time.time()
-    epoch_loss = []
-    epoch_acc = []
+    epoch_loss = torch.zeros((), device=device) # summed on device, synced once per epoch
+    epoch_acc = torch.zeros((), device=device)
+    n_batches = 0
     epoch_acc_val = []
     epoch_loss_val = []
 
     model.train()
     for batch in cl :
-        batch = batch.to(device)
+        batch = batch.to(device, non_blocking=True)
         optimizer.zero_grad()
         output = model(batch)
         # y_true = batch.y.to(device)
@@ -311,20 +347,21 @@ def train(epoch):
         if clip is not None :
             torch.nn.utils.clip_grad_norm_(model.parameters(),clip)
         optimizer.step()
-        epoch_loss.append(loss.item())
-        epoch_acc.append(accuracy(output, batch.y).item())
+        epoch_loss += loss.detach()
+        epoch_acc += accuracy(output, batch.y)
+        n_batches += 1
+    epoch_loss = (epoch_loss / n_batches).item()
+    epoch_acc = (epoch_acc / n_batches).item()
     if not fastmode :
-        d_val = Data(x=features_val,edge_index=edge_index_val,y=labels_val)
-        d_val = d_val.to(device)
         model.eval()
         output = model(d_val)
         loss_val = F.nll_loss(output, d_val.y)
         acc_val = accuracy(output,d_val.y).item()
-        print('Epoch {}\t<loss>={:.4f}\t<acc>={:.4f}\tloss_val={:.4f}\tacc_val={:.4f}\tin {:.2f}-s'.format(epoch,np.mean(epoch_loss),np.mean(epoch_acc),loss_val.item(),acc_val,time.time() - t))
+        print('Epoch {}\t<loss>={:.4f}\t<acc>={:.4f}\tloss_val={:.4f}\tacc_val={:.4f}\tin {:.2f}-s'.format(epoch,epoch_loss,epoch_acc,loss_val.item(),acc_val,time.time() - t))
         return loss_val.item()
     else :
-        print('Epoch {}\t<loss>={:.4f}\t<acc>={:.4f}\tin {:.2f}-s'.format(epoch,np.mean(epoch_loss),np.mean(epoch_acc),time.time()-t))
-        return np.mean(epoch_loss)
+        print('Epoch {}\t<loss>={:.4f}\t<acc>={:.4f}\tin {:.2f}-s'.format(epoch,epoch_loss,epoch_acc,time.time()-t))
+        return epoch_loss
 
 
 def compute_test():
@@ -334,14 +371,14 @@ def compute_test():
 
     features_test = torch.from_numpy(datapkl['features'].todense()).float()
     labels_test = torch.LongTensor(datapkl['labels'])
-    edge_index_test,_ = scipysparse2torchsparse(datapkl['adj'])
+    edge_index_test = scipysparse2edge_index(datapkl['adj'])
     del datapkl
 
     d_test = Data(x=features_test,edge_index=edge_index_test,y=labels_test)
     del features_test,edge_index_test,labels_test
 
     model.eval()
-    d_test=d_test.to(device)
+    d_test=add_adj_t(d_test).to(device)
     output = model(d_test)
     loss_test = F.nll_loss(output, d_test.y)
 #     loss_test = nn.BCEWithLogitsLoss(output[idx_test], labels[idx_test])
@@ -356,38 +393,31 @@ loss_values = []
 bad_counter = 0
 best = nEpochs + 1
 best_epoch = 0
+best_state = None # best weights kept in memory, written once after training
 for epoch in range(nEpochs):
     loss_values.append(train(epoch))
 
-    torch.save(model.state_dict(), '{}-'.format(epoch)+replicate+'.pkl')
     if loss_values[-1] < best:
         best = loss_values[-1]
         best_epoch = epoch
+        best_state = snapshot_state(model)
         bad_counter = 0
     else:
         bad_counter += 1
+    if best_state is None : # no improvement yet (e.g. NaN loss), fall back to epoch 0
+        best_state = snapshot_state(model)
 
     if bad_counter == patience:
         break
 
-    files = glob.glob('*-'+replicate+'.pkl')
-    for file in files:
-        epoch_nb = int(file.split('-'+replicate+'.pkl')[0])
-        if epoch_nb < best_epoch:
-            os.remove(file)
-
-files = glob.glob('*-'+replicate+'.pkl')
-for file in files:
-    epoch_nb = int(file.split('-'+replicate+'.pkl')[0])
-    if epoch_nb > best_epoch:
-        os.remove(file)
+torch.save(best_state, '{}-'.format(best_epoch)+replicate+'.pkl')
 
 print('Optimization Finished!')
 print('Total time elapsed: {:.2f}-min'.format((time.time() - t_total)/60))
 
 # Restore best model
 print('Loading epoch #{}'.format(best_epoch))
-model.load_state_dict(torch.load('{}-'.format(best_epoch)+replicate+'.pkl'))
+model.load_state_dict(best_state)
 
 # Testing
 compute_test()
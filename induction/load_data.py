@@ -8,7 +8,7 @@ Neal G. Ravindra, 200228
 '''
 
 
-import os,sys,pickle,time,random,glob
+import os,sys,pickle,hashlib,time,random,glob,functools
 import numpy as np
 import pandas as pd
 
@@ -17,27 +17,39 @@ import copy
 import os.path as osp
 import torch
 import torch.utils.data
-from torch_sparse import SparseTensor, cat
+from torch_sparse import SparseTensor
 from torch_geometric.data import Data
 import torch.nn.functional as F
 from torch_geometric.nn import GCNConv, GATConv
 
 
 ## utils
-def scipysparse2torchsparse(x) :
+def scipysparse2edge_index(x) :
     '''
     Input: scipy csr_matrix
-    Returns: torch tensor in experimental sparse format
+    Returns: edge_index (2 x nnz LongTensor), the COO row/col copied once into int64
 
     REF: Code adatped from [PyTorch discussion forum](https://discuss.pytorch.org/t/better-way-to-forward-sparse-matrix/21915>)
     '''
-    samples=x.shape[0]
-    features=x.shape[1]
-    values=x.data
     coo_data=x.tocoo()
-    indices=torch.LongTensor([coo_data.row,coo_data.col]) # OR transpose list of index tuples
-    t=torch.sparse.FloatTensor(indices,torch.from_numpy(values).float(),[samples,features])
-    return indices,t
+    edge_index=np.empty((2,coo_data.nnz),dtype=np.int64)
+    edge_index[0],edge_index[1]=coo_data.row,coo_data.col
+    return torch.from_numpy(edge_index)
+
+@functools.lru_cache(maxsize=2)
+def _load_pkl(path):
+    '''
+    Unpickle once per path so repeated `get_data` calls (e.g. sweeps) reuse it.
+
+    The cache keeps up to two unpickled datasets alive for the whole process;
+    treat the returned dict as read-only and call `clear_pkl_cache()` to free it.
+    '''
+    with open(path,'rb') as f :
+        return pickle.load(f)
+
+def clear_pkl_cache():
+    '''Release the datasets held by `_load_pkl`'''
+    _load_pkl.cache_clear()
 
 
 ## load data
@@ -48,7 +60,9 @@ def get_data(pdfp = '/home/ngr4/project/scgraph/data/processed/',
              replicate=sys.argv[1], # for pkl file saved
              BatchSize = 256,
              NumParts = 4000,
+             save_dir = None, # METIS partition cache, defaults to `pdfp/<data_train_pkl stem>`
              Device = 'cuda',
+             NumWorkers = 4,
              fastmode=False) :
 
     class ClusterData(torch.utils.data.Dataset):
@@ -63,8 +77,10 @@ def get_data(pdfp = '/home/ngr4/project/scgraph/data/processed/',
             recursive (bool, optional): If set to :obj:`True`, will use multilevel
                 recursive bisection instead of multilevel k-way partitioning.
                 (default: :obj:`False`)
-            save_dir (string, optional): If set, will save the partitioned data to
-                the :obj:`save_dir` directory for faster re-use.
+            save_dir (string, optional): If set, will save the partition
+                (adjacency, :obj:`partptr`, :obj:`perm`) to the :obj:`save_dir`
+                directory for faster re-use. The file name includes a hash of
+                :obj:`edge_index`, so a changed graph is re-partitioned.
         """
         def __init__(self, data, num_parts, recursive=False, save_dir=None):
             assert (data.edge_index is not None)
@@ -77,29 +93,36 @@ def get_data(pdfp = '/home/ngr4/project/scgraph/data/processed/',
 
         def process(self, data):
             recursive = '_recursive' if self.recursive else ''
-            filename = f'part_data_{self.num_parts}{recursive}.pt'
+            # key the cache on the graph itself so a pickle regenerated under the same
+            # name (new kNN graph or cells) never picks up a partition of the old one
+            num_nodes, num_edges = data.num_nodes, data.edge_index.size(1)
+            digest = hashlib.sha1(data.edge_index.numpy()).hexdigest()[:12]
+            filename = f'part_data_{self.num_parts}{recursive}_{digest}.pt'
 
+            # only the partition is cached; node tensors are re-permuted every run
             path = osp.join(self.save_dir or '', filename)
+            adj = None
             if self.save_dir is not None and osp.exists(path):
-                data, partptr, perm = torch.load(path)
-            else:
-                data = copy.copy(data)
-                num_nodes = data.num_nodes
-
+                adj, partptr, perm = torch.load(path, weights_only=False)
+                if perm.numel() != num_nodes or adj.nnz() != num_edges:
+                    adj = None
+            if adj is None:
                 (row, col), edge_attr = data.edge_index, data.edge_attr
                 adj = SparseTensor(row=row, col=col, value=edge_attr)
                 adj, partptr, perm = adj.partition(self.num_parts, self.recursive)
 
-                for key, item in data:
-                    if item.size(0) == num_nodes:
-                        data[key] = item[perm]
+                if self.save_dir is not None:
+                    torch.save((adj, partptr, perm), path)
+
+            data = copy.copy(data)
+            data.edge_index = None
+            data.edge_attr = None
 
-                data.edge_index = None
-                data.edge_attr = None
-                data.adj = adj
+            for key, item in data:
+                if item.size(0) == num_nodes:
+                    data[key] = item[perm]
 
-                if self.save_dir is not None:
-                    torch.save((data, partptr, perm), path)
+            data.adj = adj
 
             self.data = data
             self.perm = perm
@@ -163,43 +186,56 @@ def get_data(pdfp = '/home/ngr4/project/scgraph/data/processed/',
 
                     data = copy.copy(cluster_data.data)
                     num_nodes = data.num_nodes
+                    data.adj = None # collate gathers rows from cluster_data.data.adj directly
                     for key, item in data:
                         if item.size(0) == num_nodes:
                             data[key] = item.narrow(0, start, length)
 
                     return data, idx
 
+            # batch-local relabelling of node ids, reset after every batch
+            node_map = torch.full((cluster_data.data.adj.size(1),), -1, dtype=torch.long)
+
             def collate(batch):
                 data_list = [data[0] for data in batch]
                 parts: List[int] = [data[1] for data in batch]
                 partptr = cluster_data.partptr
 
-                adj = cat([data.adj for data in data_list], dim=0)
-
-                adj = adj.t()
-                adjs = []
-                for part in parts:
-                    start = partptr[part]
-                    length = partptr[part + 1] - start
-                    adjs.append(adj.narrow(0, start, length))
-                adj = cat(adjs, dim=0).t()
-                row, col, value = adj.coo()
+                # node ids of the sampled parts in batch order, gathered in one row select
+                parts_t = torch.tensor(parts, dtype=torch.long)
+                start = partptr[parts_t]
+                length = partptr[parts_t + 1] - start
+                num_nodes = int(length.sum())
+                node_idx = (torch.repeat_interleave(start - (length.cumsum(0) - length), length)
+                            + torch.arange(num_nodes))
+                row, col, value = cluster_data.data.adj.index_select(0, node_idx).coo()
+
+                # keep only the links between the sampled parts, relabelled to batch ids
+                node_map[node_idx] = torch.arange(num_nodes)
+                col = node_map[col]
+                node_map[node_idx] = -1
+                keep = col >= 0
+                value = value[keep] if value is not None else None
+                adj = SparseTensor(row=row[keep], col=col[keep], value=value,
+                                   sparse_sizes=(num_nodes, num_nodes))
 
                 data = cluster_data.data.__class__()
                 data.num_nodes = adj.size(0)
-                data.edge_index = torch.stack([row, col], dim=0)
-                data.edge_attr = value
+                data.adj_t = adj.t()
 
                 ref = data_list[0]
-                keys = ref.keys
-                keys.remove('adj')
-
-                for key in keys:
-                    if ref[key].size(0) != ref.adj.size(0):
+                for key in ref.keys:
+                    if ref[key].size(0) != ref.num_nodes:
                         data[key] = ref[key]
                     else:
-                        data[key] = torch.cat([d[key] for d in data_list],
-                                              dim=ref.__cat_dim__(key, ref[key]))
+                        cat_dim = ref.__cat_dim__(key, ref[key])
+                        items = [d[key] for d in data_list]
+                        if items[0].device.type == 'cpu' and items[0].dtype != torch.bfloat16:
+                            # one numpy concat avoids torch.cat dispatch overhead on many small parts
+                            data[key] = torch.from_numpy(
+                                np.concatenate([item.numpy() for item in items], axis=cat_dim))
+                        else:
+                            data[key] = torch.cat(items, dim=cat_dim)
 
                 return data
 
@@ -210,29 +246,30 @@ def get_data(pdfp = '/home/ngr4/project/scgraph/data/processed/',
 
 
     ## data
-    with open(os.path.join(pdfp,data_train_pkl),'rb') as f :
-        datapkl = pickle.load(f)
-        f.close()
+    datapkl = _load_pkl(os.path.join(pdfp,data_train_pkl))
 
     node_features = torch.from_numpy(datapkl['features'].todense()).float()
-    # _,node_features = scipysparse2torchsparse(features)
     labels = torch.LongTensor(datapkl['labels'])
-    edge_index,_ = scipysparse2torchsparse(datapkl['adj'])
-    del datapkl
+    num_classes = int(labels.max()) + 1
+    edge_index = scipysparse2edge_index(datapkl['adj'])
+    del datapkl # local ref only, the dict stays in the _load_pkl cache
 
     d = Data(x=node_features, edge_index=edge_index, y=labels)
     del node_features,edge_index,labels
 
-    cd = ClusterData(d,num_parts=NumParts)
-    cl = ClusterLoader(cd,batch_size=BatchSize,shuffle=True)
+    if save_dir is None :
+        save_dir = os.path.join(pdfp,os.path.splitext(data_train_pkl)[0])
+    os.makedirs(save_dir,exist_ok=True)
+    cd = ClusterData(d,num_parts=NumParts,save_dir=save_dir)
+    cl = ClusterLoader(cd,batch_size=BatchSize,shuffle=True,
+                       num_workers=NumWorkers,pin_memory=(Device != 'cpu'),
+                       persistent_workers=(NumWorkers > 0))
 
     if not fastmode :
-        with open(os.path.join(pdfp,data_val_pkl),'rb') as f :
-            datapkl = pickle.load(f)
-            f.close()
+        datapkl = _load_pkl(os.path.join(pdfp,data_val_pkl))
 
         features_val = torch.from_numpy(datapkl['features'].todense()).float()
         labels_val = torch.LongTensor(datapkl['labels'])
-        edge_index_val,_ = scipysparse2torchsparse(datapkl['adj'])
-        del datapkl
-    return cl
+        edge_index_val = scipysparse2edge_index(datapkl['adj'])
+        del datapkl # local ref only, the dict stays in the _load_pkl cache
+    return cl, num_classes
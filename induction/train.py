@@ -7,7 +7,7 @@ ACM CHIL 2020 paper
 Neal G. Ravindra, 200228
 '''
 
-import os,sys,pickle,time,random,glob
+import os,sys,pickle,time,random
 import numpy as np
 import pandas as pd
 
@@ -23,26 +23,33 @@ from torch_geometric.nn import GCNConv, GATConv
 
 
 ## utils
-def scipysparse2torchsparse(x) :
+def scipysparse2edge_index(x) :
     '''
     Input: scipy csr_matrix
-    Returns: torch tensor in experimental sparse format
+    Returns: edge_index (2 x nnz LongTensor), the COO row/col copied once into int64
 
     REF: Code adatped from [PyTorch discussion forum](https://discuss.pytorch.org/t/better-way-to-forward-sparse-matrix/21915>)
     '''
-    samples=x.shape[0]
-    features=x.shape[1]
-    values=x.data
     coo_data=x.tocoo()
-    indices=torch.LongTensor([coo_data.row,coo_data.col]) # OR transpose list of index tuples
-    t=torch.sparse.FloatTensor(indices,torch.from_numpy(values).float(),[samples,features])
-    return indices,t
+    edge_index=np.empty((2,coo_data.nnz),dtype=np.int64)
+    edge_index[0],edge_index[1]=coo_data.row,coo_data.col
+    return torch.from_numpy(edge_index)
 
 def accuracy(output, labels):
-    preds = output.max(1)[1].type_as(labels)
-    correct = preds.eq(labels).double()
-    correct = correct.sum()
-    return correct / len(labels)
+    preds = output.argmax(1)
+    return preds.eq(labels).float().mean()
+
+def add_adj_t(data):
+    '''Cache the transposed adjacency so GATConv skips the per-call CSR build'''
+    row, col = data.edge_index
+    data.adj_t = SparseTensor(row=row, col=col, value=None,
+                              sparse_sizes=(data.num_nodes, data.num_nodes)).t()
+    data.edge_index = None # GAT reads adj_t only; don't copy edge_index to device
+    return data
+
+def snapshot_state(model):
+    '''Detached CPU copy of the model weights'''
+    return {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
 
 def main() :
     
@@ -57,7 +64,9 @@ def main() :
 
     BatchSize = 256
     NumParts = 4000 # num sub-graphs
+    save_dir = os.path.join(pdfp,os.path.splitext(data_train_pkl)[0]) # METIS partition cache
     Device = 'cuda' # if no gpu, `Device='cpu'`
+    NumWorkers = 4 # DataLoader workers for sub-graph collate
     LR = 0.001 # learning rate
     WeightDecay=5e-4
     fastmode = False # if `fastmode=False`, report validation
@@ -77,16 +86,19 @@ def main() :
         f.close()
 
     node_features = torch.from_numpy(datapkl['features'].todense()).float()
-    # _,node_features = scipysparse2torchsparse(features)
     labels = torch.LongTensor(datapkl['labels'])
-    edge_index,_ = scipysparse2torchsparse(datapkl['adj'])
+    num_classes = int(labels.max()) + 1
+    edge_index = scipysparse2edge_index(datapkl['adj'])
     del datapkl
 
     d = Data(x=node_features, edge_index=edge_index, y=labels)
     del node_features,edge_index,labels
 
-    cd = ClusterData(d,num_parts=NumParts)
-    cl = ClusterLoader(cd,batch_size=BatchSize,shuffle=True)
+    os.makedirs(save_dir,exist_ok=True)
+    cd = ClusterData(d,num_parts=NumParts,save_dir=save_dir)
+    cl = ClusterLoader(cd,batch_size=BatchSize,shuffle=True,
+                       num_workers=NumWorkers,pin_memory=(Device != 'cpu'),
+                       persistent_workers=(NumWorkers > 0))
 
     if not fastmode :
         with open(os.path.join(pdfp,data_val_pkl),'rb') as f :
@@ -95,25 +107,25 @@ def main() :
 
         features_val = torch.from_numpy(datapkl['features'].todense()).float()
         labels_val = torch.LongTensor(datapkl['labels'])
-        edge_index_val,_ = scipysparse2torchsparse(datapkl['adj'])
+        edge_index_val = scipysparse2edge_index(datapkl['adj'])
         del datapkl
 
     ## model
     class GAT(torch.nn.Module):
-        def __init__(self):
+        def __init__(self, num_classes):
             super(GAT, self).__init__()
             self.gat1 = GATConv(d.num_node_features, out_channels=nHiddenUnits,
                                 heads=nHeads, concat=True, negative_slope=alpha,
                                 dropout=dropout, bias=True)
-            self.gat2 = GATConv(nHiddenUnits*nHeads, d.y.unique().size()[0],
+            self.gat2 = GATConv(nHiddenUnits*nHeads, num_classes,
                                 heads=nHeads, concat=False, negative_slope=alpha,
                                 dropout=dropout, bias=True)
 
         def forward(self, data):
-            x, edge_index = data.x, data.edge_index
-            x = self.gat1(x, edge_index)
+            x, adj_t = data.x, data.adj_t
+            x = self.gat1(x, adj_t)
             x = F.elu(x)
-            x = self.gat2(x, edge_index)
+            x = self.gat2(x, adj_t)
             return F.log_softmax(x, dim=1)
 
 
@@ -123,29 +135,31 @@ def main() :
     else :
         device = torch.device(Device)
 
-    random.seed(rs)
+    torch.manual_seed(rs) # seeds all CUDA devices too
     np.random.seed(rs)
-    torch.manual_seed(rs)
-    if Device == 'cuda' :
-        torch.cuda.manual_seed(rs)
+    random.seed(rs)
 
-    model = GAT().to(device)
+    model = GAT(num_classes).to(device)
     optimizer = torch.optim.Adagrad(model.parameters(),
                                     lr=LR,
                                     weight_decay=WeightDecay)
 
     # features, adj, labels = Variable(features), Variable(adj), Variable(labels)
 
+    if not fastmode :
+        d_val = add_adj_t(Data(x=features_val,edge_index=edge_index_val,y=labels_val)).to(device)
+
     def train(epoch):
         t = time.time()
-        epoch_loss = []
-        epoch_acc = []
+        epoch_loss = torch.zeros((), device=device) # summed on device, synced once per epoch
+        epoch_acc = torch.zeros((), device=device)
+        n_batches = 0
         epoch_acc_val = []
         epoch_loss_val = []
 
         model.train()
         for batch in cl :
-            batch = batch.to(device)
+            batch = batch.to(device, non_blocking=True)
             optimizer.zero_grad()
             output = model(batch)
             # y_true = batch.y.to(device)
@@ -154,20 +168,21 @@ def main() :
             if clip is not None :
                 torch.nn.utils.clip_grad_norm_(model.parameters(),clip)
             optimizer.step()
-            epoch_loss.append(loss.item())
-            epoch_acc.append(accuracy(output, batch.y).item())
+            epoch_loss += loss.detach()
+            epoch_acc += accuracy(output, batch.y)
+            n_batches += 1
+        epoch_loss = (epoch_loss / n_batches).item()
+        epoch_acc = (epoch_acc / n_batches).item()
         if not fastmode :
-            d_val = Data(x=features_val,edge_index=edge_index_val,y=labels_val)
-            d_val = d_val.to(device)
             model.eval()
             output = model(d_val)
             loss_val = F.nll_loss(output, d_val.y)
             acc_val = accuracy(output,d_val.y).item()
-            print('Epoch {}\t<loss>={:.4f}\t<acc>={:.4f}\tloss_val={:.4f}\tacc_val={:.4f}\tin {:.2f}-s'.format(epoch,np.mean(epoch_loss),np.mean(epoch_acc),loss_val.item(),acc_val,time.time() - t))
+            print('Epoch {}\t<loss>={:.4f}\t<acc>={:.4f}\tloss_val={:.4f}\tacc_val={:.4f}\tin {:.2f}-s'.format(epoch,epoch_loss,epoch_acc,loss_val.item(),acc_val,time.time() - t))
             return loss_val.item()
         else :
-            print('Epoch {}\t<loss>={:.4f}\t<acc>={:.4f}\tin {:.2f}-s'.format(epoch,np.mean(epoch_loss),np.mean(epoch_acc),time.time()-t))
-            return np.mean(epoch_loss)
+            print('Epoch {}\t<loss>={:.4f}\t<acc>={:.4f}\tin {:.2f}-s'.format(epoch,epoch_loss,epoch_acc,time.time()-t))
+            return epoch_loss
 
 
     def compute_test():
@@ -177,14 +192,14 @@ def main() :
 
         features_test = torch.from_numpy(datapkl['features'].todense()).float()
         labels_test = torch.LongTensor(datapkl['labels'])
-        edge_index_test,_ = scipysparse2torchsparse(datapkl['adj'])
+        edge_index_test = scipysparse2edge_index(datapkl['adj'])
         del datapkl
 
         d_test = Data(x=features_test,edge_index=edge_index_test,y=labels_test)
         del features_test,edge_index_test,labels_test
 
         model.eval()
-        d_test=d_test.to(device)
+        d_test=add_adj_t(d_test).to(device)
         output = model(d_test)
         loss_test = F.nll_loss(output, d_test.y)
     #     loss_test = nn.BCEWithLogitsLoss(output[idx_test], labels[idx_test])
@@ -199,38 +214,31 @@ def main() :
     bad_counter = 0
     best = nEpochs + 1
     best_epoch = 0
+    best_state = None # best weights kept in memory, written once after training
     for epoch in range(nEpochs):
         loss_values.append(train(epoch))
 
-        torch.save(model.state_dict(), '{}-'.format(epoch)+replicate+'.pkl')
         if loss_values[-1] < best:
             best = loss_values[-1]
             best_epoch = epoch
+            best_state = snapshot_state(model)
             bad_counter = 0
         else:
             bad_counter += 1
+        if best_state is None : # no improvement yet (e.g. NaN loss), fall back to epoch 0
+            best_state = snapshot_state(model)
 
         if bad_counter == patience:
             break
 
-        files = glob.glob('*-'+replicate+'.pkl')
-        for file in files:
-            epoch_nb = int(file.split('-'+replicate+'.pkl')[0])
-            if epoch_nb < best_epoch:
-                os.remove(file)
-
-    files = glob.glob('*-'+replicate+'.pkl')
-    for file in files:
-        epoch_nb = int(file.split('-'+replicate+'.pkl')[0])
-        if epoch_nb > best_epoch:
-            os.remove(file)
+    torch.save(best_state, '{}-'.format(best_epoch)+replicate+'.pkl')
 
     print('Optimization Finished!')
     print('Total time elapsed: {:.2f}-min'.format((time.time() - t_total)/60))
 
     # Restore best model
     print('Loading epoch #{}'.format(best_epoch))
-    model.load_state_dict(torch.load('{}-'.format(best_epoch)+replicate+'.pkl'))
+    model.load_state_dict(best_state)
 
     # Testing
     compute_test()
@@ -37,23 +37,22 @@ alpha = 0.2 # alpha for leaky_relu
 patience = 100 # epochs to beat
 clip = None # set `clip=1` to turn on gradient clipping
 rs=random.randint(1,1000000) # random_seed
-n_nodes=d.y.unique().size()[0] # set manually if d not loaded
 ################################################################################
 
 ## model
 class GAT(torch.nn.Module):
-    def __init__(self):
+    def __init__(self, num_classes):
         super(GAT, self).__init__()
         self.gat1 = GATConv(d.num_node_features, out_channels=nHiddenUnits,
                             heads=nHeads, concat=True, negative_slope=alpha,
                             dropout=dropout, bias=True)
-        self.gat2 = GATConv(nHiddenUnits*nHeads, n_nodes,
+        self.gat2 = GATConv(nHiddenUnits*nHeads, num_classes,
                             heads=nHeads, concat=False, negative_slope=alpha,
                             dropout=dropout, bias=True)
 
     def forward(self, data):
-        x, edge_index = data.x, data.edge_index
-        x = self.gat1(x, edge_index)
+        x, adj_t = data.x, data.adj_t
+        x = self.gat1(x, adj_t)
         x = F.elu(x)
-        x = self.gat2(x, edge_index)
+        x = self.gat2(x, adj_t)
         return F.log_softmax(x, dim=1)